@@ -8,6 +8,7 @@ setup(
     author_email="marcsole@insomniacwolves.com",
     install_requires=[
         'spotipy==2.4.4',
+        'numpy',
     ],
     license='LICENSE.txt',
     packages=['spotify-account']
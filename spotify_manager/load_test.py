@@ -0,0 +1,459 @@
+"""
+    Load and soak testing harness for SpotifyManager.
+
+    Runs many concurrent user sessions, each one with its own SpotifyManager, against a local fake
+    Spotify Web API with configurable latency and rate limiting. Every session sends a realistic mix of
+    commands and the harness reports throughput, latency percentiles and error rates per method, and
+    memory growth along the run. Memory is sampled as the resident set size of the process, so it
+    doesn't slow the sessions down. The fake API runs in a child process, so memory samples only count
+    the sessions and the harness.
+
+    Usage::
+
+        python -m spotify_manager.load_test --users 50 --duration 600 --latency 0.05 --rate-limit 10
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from spotify_manager.spotify_manager import SpotifyManager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def _make_track(i):
+    artist, album = i % 97, i % 311
+    return {'id': str(i), 'uri': 'spotify:track:%d' % i, 'name': 'Track %d' % i, 'duration_ms': 180000,
+            'artists': [{'id': str(artist), 'uri': 'spotify:artist:%d' % artist,
+                         'name': 'Artist %d' % artist}],
+            'album': {'id': str(album), 'uri': 'spotify:album:%d' % album, 'name': 'Album %d' % album,
+                      'release_date': '2018-05-04'}}
+
+
+class FakeSpotifyAPI:
+    """
+        Local fake of the Spotify Web API endpoints used by SpotifyManager.
+
+        Each bearer token is a different user with its own player. Every request waits latency seconds
+        plus a random jitter, and users that send more than rate_limit requests per second receive a 429
+        response with a Retry-After header.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit=0, host='127.0.0.1', port=0):
+        """
+            :param latency: Seconds each request takes.
+            :param jitter: Maximum random seconds added to latency.
+            :param rate_limit: Maximum requests per second of each user. 0 to disable.
+            :param host: Host to listen on.
+            :param port: Port to listen on, 0 to pick a free one.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self._players = {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                api._handle(self, 'GET')
+
+            def do_PUT(self):
+                api._handle(self, 'PUT')
+
+            def do_POST(self):
+                api._handle(self, 'POST')
+
+            def do_DELETE(self):
+                api._handle(self, 'DELETE')
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def prefix(self):
+        return 'http://%s:%d/v1/' % self._server.server_address[:2]
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handle(self, handler, method):
+        url = urlparse(handler.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = json.loads(handler.rfile.read(length) or 'null') if length else None
+        user = handler.headers.get('Authorization', '').replace('Bearer ', '')
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.random() * self.jitter)
+        if self.rate_limit and not self._take_token(user):
+            return self._reply(handler, 429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}},
+                               {'Retry-After': '1'})
+        with self._lock:
+            player = self._players.setdefault(user, {'volume': 50, 'is_playing': True, 'item': _make_track(0),
+                                                     'queue': [], 'played': 0})
+            status, payload, headers = self._route(player, method, url.path[len('/v1/'):], params, body,
+                                                   handler.headers)
+        self._reply(handler, status, payload, headers)
+
+    def _take_token(self, user):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(user, (self.rate_limit, now))
+            tokens = min(self.rate_limit, tokens + (now - updated_at) * self.rate_limit)
+            allowed = tokens >= 1
+            self._buckets[user] = (tokens - 1 if allowed else tokens, now)
+        return allowed
+
+    def _route(self, player, method, path, params, body, headers):
+        limit = int(params.get('limit', 20))
+        if path == 'me/player/devices':
+            return 200, {'devices': [{'id': 'device', 'name': 'speaker', 'type': 'Speaker', 'is_active': True,
+                                      'is_restricted': False, 'volume_percent': player['volume']}]}, {}
+        if path == 'me/player/currently-playing':
+            return 200, {'item': player['item'], 'progress_ms': 1000, 'is_playing': player['is_playing']}, {}
+        if path == 'me/player':
+            return 200, {'item': player['item'], 'progress_ms': 1000, 'is_playing': player['is_playing'],
+                         'repeat_state': 'off', 'shuffle_state': False,
+                         'device': {'id': 'device', 'volume_percent': player['volume']}}, {}
+        if path == 'me/player/volume':
+            player['volume'] = int(params['volume_percent'])
+            return 204, None, {}
+        if path == 'me/player/play':
+            player['is_playing'] = True
+            player['queue'] = []
+            if body and body.get('uris'):
+                player['item'] = _make_track(int(body['uris'][0].split(':')[-1]))
+            elif body and body.get('context_uri'):
+                player['item'] = _make_track(random.randrange(10000))
+            return 204, None, {}
+        if path == 'me/player/pause':
+            player['is_playing'] = False
+            return 204, None, {}
+        if path in ('me/player/next', 'me/player/previous'):
+            player['played'] += 1
+            if player['queue']:
+                player['item'] = player['queue'].pop(0)
+            else:
+                player['item'] = _make_track(random.randrange(10000))
+            return 204, None, {}
+        if path in ('me/player/seek', 'me/player/shuffle', 'me/player/repeat'):
+            return 204, None, {}
+        if path == 'me/player/queue':
+            player['queue'].append(_make_track(int(params['uri'].split(':')[-1])))
+            return 204, None, {}
+        if path == 'me/player/recently-played':
+            newest = int(time.time() * 1000) - 1000
+            after = int(params.get('after', 0))
+            items = []
+            for i in range(min(limit, player['played'] + 1)):
+                played_at = newest - i * 180000
+                if played_at <= after:
+                    break
+                items.append({'track': _make_track(i), 'played_at': time.strftime(
+                    '%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(played_at / 1000))})
+            return 200, {'items': items, 'cursors': {'after': str(newest)}}, {}
+        if path == 'recommendations':
+            start = random.randrange(10000)
+            return 200, {'tracks': [_make_track(start + i) for i in range(limit)]}, {}
+        if path == 'search':
+            kind = params.get('type', 'track')
+            item = _make_track(random.randrange(10000))
+            if kind != 'track':
+                item = {'uri': 'spotify:%s:%d' % (kind, random.randrange(10000)), 'name': params.get('q')}
+            return 200, {kind + 's': {'items': [item]}}, {}
+        if path == 'me/playlists':
+            offset = int(params.get('offset', 0))
+            items = [{'id': 'p%d' % i, 'uri': 'spotify:playlist:p%d' % i, 'name': 'Playlist %d' % i,
+                      'snapshot_id': 's%d' % i} for i in range(offset, min(offset + limit, 120))]
+            return 200, {'items': items, 'next': None if offset + limit >= 120 else 'next'}, {}
+        if path in ('me/top/artists', 'me/top/tracks'):
+            if path.endswith('artists'):
+                items = [{'id': str(i), 'uri': 'spotify:artist:%d' % i, 'name': 'Artist %d' % i}
+                         for i in range(limit)]
+            else:
+                items = [_make_track(i) for i in range(limit)]
+            return 200, {'items': items}, {}
+        match = re.match(r'artists/(\w+)/top-tracks$', path) or re.match(r'albums/(\w+)$', path)
+        if match:
+            if headers.get('If-None-Match') == '"v1"':
+                return 304, None, {'ETag': '"v1"', 'Cache-Control': 'max-age=60'}
+            if path.startswith('albums'):
+                payload = dict(_make_track(int(match.group(1)))['album'])
+            else:
+                payload = {'tracks': [_make_track(int(match.group(1)) * 10 + i) for i in range(10)]}
+            return 200, payload, {'ETag': '"v1"', 'Cache-Control': 'max-age=60'}
+        return 404, {'error': {'status': 404, 'message': 'Service not found'}}, {}
+
+    @staticmethod
+    def _reply(handler, status, payload, headers):
+        data = json.dumps(payload).encode('utf-8') if payload is not None else b''
+        handler.send_response(status)
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        if data:
+            handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+
+class FakeSpotifyAPIProcess:
+    """
+        Runs a FakeSpotifyAPI in a child process, so it shares neither memory nor the GIL with the
+        sessions being measured.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit=0):
+        """
+            :param latency: Seconds each request takes.
+            :param jitter: Maximum random seconds added to latency.
+            :param rate_limit: Maximum requests per second of each user. 0 to disable.
+        """
+        context = multiprocessing.get_context('spawn')
+        self.prefix = None
+        self._prefix = context.Queue()
+        self._process = context.Process(target=_serve, args=(latency, jitter, rate_limit, self._prefix),
+                                        daemon=True)
+
+    def start(self):
+        self._process.start()
+        self.prefix = self._prefix.get(timeout=30)
+
+    def stop(self):
+        self._process.terminate()
+        self._process.join()
+
+
+def _serve(latency, jitter, rate_limit, prefix):
+    api = FakeSpotifyAPI(latency, jitter, rate_limit)
+    prefix.put(api.prefix)
+    api._server.serve_forever()
+
+
+# Relative weights of the commands sent by every session.
+COMMAND_MIX = {
+    'volume_burst': 25,
+    'next_song': 20,
+    'switch_play_pause': 10,
+    'get_current_song_info': 15,
+    'play_genre': 8,
+    'play_playlist': 6,
+    'play_recently_played': 5,
+    'play_top_tracks': 5,
+    'play_top_artists': 3,
+    'play_similar_from_current_artist': 3,
+}
+
+
+class LoadTest:
+    """
+        Drives concurrent SpotifyManager sessions against a FakeSpotifyAPI and collects metrics.
+    """
+
+    def __init__(self, api, users=10, duration=60, think_time=0.1, command_mix=None, sample_interval=5):
+        """
+            :param api: Started FakeSpotifyAPIProcess, or FakeSpotifyAPI if memory is not a concern.
+            :param users: Number of concurrent sessions.
+            :param duration: Seconds the test runs.
+            :param think_time: Maximum random seconds each session waits between commands.
+            :param command_mix: Dictionary of command names and relative weights.
+            :param sample_interval: Seconds between memory samples. The first one is taken before the
+                                    sessions start.
+        """
+        self.api = api
+        self.users = users
+        self.duration = duration
+        self.think_time = think_time
+        self.command_mix = command_mix or COMMAND_MIX
+        self.sample_interval = sample_interval
+        self.latencies = {}
+        self.errors = {}
+        self.memory = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def run(self):
+        """
+            Runs the test and returns its report.
+
+            :return: Dictionary with the results, see report().
+        """
+        cache_dir = tempfile.mkdtemp(prefix='spotify-manager-load-')
+        started = time.monotonic()
+        try:
+            managers, sessions = [], []
+            for i in range(self.users):
+                manager = SpotifyManager('user-%d' % i, None, None, None, token='user-%d' % i,
+                                         catalog_cache_dir=os.path.join(cache_dir, str(i)))
+                manager.sp.prefix = self.api.prefix
+                managers.append(manager)
+                sessions.append(threading.Thread(target=self._run_session, args=(manager,), daemon=True))
+            self._sample_memory(started)
+            for session in sessions:
+                session.start()
+            while not self._stopped.wait(self.sample_interval):
+                self._sample_memory(started)
+                if time.monotonic() - started >= self.duration:
+                    self._stopped.set()
+            for session in sessions:
+                session.join()
+            self._sample_memory(started)
+            return self.report(time.monotonic() - started)
+        finally:
+            self._stopped.set()
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def report(self, elapsed):
+        """
+            Summarizes the collected metrics.
+
+            :param elapsed: Seconds the test ran.
+            :return: {'elapsed', 'throughput', 'methods': {name: {calls, errors, error_rate, p50, p95, p99}},
+                     'errors': {name: {exception: count}}, 'memory': [(seconds, bytes), ...], 'memory_growth'}
+        """
+        methods = {}
+        total = 0
+        for name in sorted(set(self.latencies) | set(self.errors)):
+            latencies = sorted(self.latencies.get(name, []))
+            errors = sum(self.errors.get(name, {}).values())
+            calls = len(latencies) + errors
+            total += calls
+            methods[name] = {'calls': calls, 'errors': errors, 'error_rate': errors / calls,
+                             'p50': _percentile(latencies, 50), 'p95': _percentile(latencies, 95),
+                             'p99': _percentile(latencies, 99)}
+        growth = self.memory[-1][1] - self.memory[0][1] if len(self.memory) > 1 else 0
+        return {'elapsed': elapsed, 'throughput': total / elapsed if elapsed else 0, 'methods': methods,
+                'errors': self.errors, 'memory': self.memory, 'memory_growth': growth}
+
+    def _run_session(self, manager):
+        names = list(self.command_mix)
+        weights = [self.command_mix[name] for name in names]
+        while not self._stopped.is_set():
+            name = random.choices(names, weights)[0]
+            started = time.perf_counter()
+            try:
+                self._send(manager, name)
+            except Exception as e:
+                with self._lock:
+                    errors = self.errors.setdefault(name, {})
+                    errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            else:
+                with self._lock:
+                    self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+            if self.think_time:
+                self._stopped.wait(random.random() * self.think_time)
+        manager.stop_queue()
+
+    @staticmethod
+    def _send(manager, name):
+        if name == 'volume_burst':
+            for _ in range(5):
+                manager.increase_volume(random.choice([-10, -5, 5, 10]))
+        elif name == 'play_genre':
+            manager.play_genre(random.choice(['rock', 'pop', 'jazz']))
+        elif name == 'play_playlist':
+            manager.play_playlist('Playlist %d' % random.randrange(150))
+        else:
+            getattr(manager, name)()
+
+    def _sample_memory(self, started):
+        self.memory.append((time.monotonic() - started, _resident_memory()))
+
+
+def _resident_memory():
+    """
+        Returns the resident set size of the process in bytes. Where /proc isn't available, falls back
+        to the peak resident set size, or 0 if neither can be read.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _percentile(values, percent):
+    """
+        Returns the nearest-rank percentile of a sorted list, or None if it's empty.
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(percent / 100 * len(values))) - 1))]
+
+
+def format_report(report):
+    """
+        Formats a LoadTest report as a text table.
+
+        :param report: Dictionary returned by LoadTest.run().
+        :return: String.
+    """
+    lines = ['Elapsed: %.1fs  Throughput: %.1f calls/s  Memory growth: %.1f KiB'
+             % (report['elapsed'], report['throughput'], report['memory_growth'] / 1024), '',
+             '%-34s %8s %8s %9s %9s %9s' % ('method', 'calls', 'errors', 'p50 ms', 'p95 ms', 'p99 ms')]
+    for name, stats in report['methods'].items():
+        percentiles = ['%9.1f' % (stats[p] * 1000) if stats[p] is not None else '%9s' % '-'
+                       for p in ('p50', 'p95', 'p99')]
+        lines.append('%-34s %8d %7.1f%% %s'
+                     % (name, stats['calls'], stats['error_rate'] * 100, ' '.join(percentiles)))
+    for name, errors in sorted(report['errors'].items()):
+        lines.append('%s errors: %s' % (name, ', '.join('%s=%d' % item for item in sorted(errors.items()))))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load and soak test SpotifyManager against a fake Web API.')
+    parser.add_argument('--users', type=int, default=10, help='concurrent sessions')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to run')
+    parser.add_argument('--think-time', type=float, default=0.1, help='maximum seconds between commands')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds each request takes')
+    parser.add_argument('--jitter', type=float, default=0.01, help='maximum random seconds added to latency')
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help='requests per second per user, 0 to disable')
+    parser.add_argument('--sample-interval', type=float, default=5, help='seconds between memory samples')
+    parser.add_argument('--json', help='also write the full report to this file')
+    args = parser.parse_args(argv)
+
+    api = FakeSpotifyAPIProcess(args.latency, args.jitter, args.rate_limit)
+    api.start()
+    try:
+        report = LoadTest(api, args.users, args.duration, args.think_time,
+                          sample_interval=args.sample_interval).run()
+    finally:
+        api.stop()
+    print(format_report(report))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,864 @@
+import csv
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import unicodedata
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from itertools import chain, takewhile
+
+import numpy as np
 from spotipy.client import Spotify, SpotifyException
 from spotipy import util
 
+logger = logging.getLogger(__name__)
+
+
+class PlaybackHistory:
+    """
+        Fixed capacity ring buffer of plays, backed by arrays.
+
+        Each play is stored as an interned track, the time it was first seen, the last progress seen and
+        an interned device. Memory doesn't grow once the buffer is full, oldest plays are overwritten and
+        their interned ids released. Plays are kept in timestamp order. It can be shared between threads.
+    """
+
+    def __init__(self, capacity=10000):
+        """
+            :param capacity: Maximum number of plays kept.
+            :raises TypeError: capacity is not an integer greater than 0.
+        """
+        if not isinstance(capacity, int) or capacity < 1:
+            raise TypeError('capacity must be an integer greater than 0.')
+        self.capacity = capacity
+        self._tracks = array('l', [0]) * capacity
+        self._devices = array('l', [0]) * capacity
+        self._timestamps = array('d', [0]) * capacity
+        self._progress = array('l', [0]) * capacity
+        self._start = 0
+        self._size = 0
+        self._ids = []
+        self._refs = array('l')
+        self._interned = {}
+        self._free = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def record(self, track_id, timestamp, progress_ms, device_id=None):
+        """
+            Records a playback read.
+
+            If it's the same play as the last one, only its progress is updated. A different track or a
+            progress lower than the last one starts a new play.
+
+            :param track_id: Track ID or URI.
+            :param timestamp: Time of the read, in seconds since the epoch. If it's older than the last
+                              play, the last play's timestamp is used instead.
+            :param progress_ms: Playback progress in milliseconds.
+            :param device_id: Device ID, if it's known.
+        """
+        with self._lock:
+            self._record(track_id, timestamp, progress_ms, device_id)
+
+    def last(self, n):
+        """
+            Returns the last n plays, newest first.
+
+            :param n: Number of plays.
+            :return: List of {track_id, timestamp, progress_ms, device_id}.
+        """
+        with self._lock:
+            return [self._get(i) for i in range(self._size - 1, max(self._size - n, 0) - 1, -1)]
+
+    def since(self, timestamp):
+        """
+            Returns the plays first seen at or after timestamp, oldest first.
+
+            :param timestamp: Time in seconds since the epoch.
+            :return: List of {track_id, timestamp, progress_ms, device_id}.
+        """
+        return self._plays(timestamp)
+
+    def top_tracks(self, k, since=None):
+        """
+            Returns the most played tracks.
+
+            :param k: Number of tracks.
+            :param since: Optional time in seconds since the epoch of the first play to count.
+            :return: List of (track_id, plays), most played first.
+        """
+        counts = Counter()
+        with self._lock:
+            for i in range(self._find(since) if since is not None else 0, self._size):
+                counts[self._tracks[(self._start + i) % self.capacity]] += 1
+            return [(self._ids[track], plays) for track, plays in counts.most_common(k)]
+
+    def export_ndjson(self, f, since=None):
+        """
+            Writes the plays as newline-delimited JSON, oldest first.
+
+            :param f: Text file object.
+            :param since: Optional time in seconds since the epoch of the first play to write.
+        """
+        for play in self._plays(since):
+            f.write(json.dumps(play) + '\n')
+
+    def export_csv(self, f, since=None):
+        """
+            Writes the plays as CSV with a header row, oldest first.
+
+            :param f: Text file object, opened with newline=''.
+            :param since: Optional time in seconds since the epoch of the first play to write.
+        """
+        writer = csv.DictWriter(f, ['track_id', 'timestamp', 'progress_ms', 'device_id'])
+        writer.writeheader()
+        writer.writerows(self._plays(since))
+
+    def _record(self, track_id, timestamp, progress_ms, device_id):
+        if self._size:
+            last = (self._start + self._size - 1) % self.capacity
+            if self._ids[self._tracks[last]] == track_id and progress_ms >= self._progress[last]:
+                self._progress[last] = progress_ms
+                if device_id is not None and self._devices[last] == -1:
+                    self._devices[last] = self._intern(device_id)
+                return
+        if self._size == self.capacity:
+            self._release(self._tracks[self._start])
+            self._release(self._devices[self._start])
+            self._start = (self._start + 1) % self.capacity
+            self._size -= 1
+        if self._size:
+            timestamp = max(timestamp, self._timestamps[(self._start + self._size - 1) % self.capacity])
+        i = (self._start + self._size) % self.capacity
+        self._tracks[i] = self._intern(track_id)
+        self._devices[i] = self._intern(device_id)
+        self._timestamps[i] = timestamp
+        self._progress[i] = progress_ms
+        self._size += 1
+
+    def _plays(self, since=None):
+        with self._lock:
+            return [self._get(i) for i in range(self._find(since) if since is not None else 0, self._size)]
+
+    def _get(self, i):
+        i = (self._start + i) % self.capacity
+        device_id = self._ids[self._devices[i]] if self._devices[i] != -1 else None
+        return {'track_id': self._ids[self._tracks[i]], 'timestamp': self._timestamps[i],
+                'progress_ms': self._progress[i], 'device_id': device_id}
+
+    def _find(self, timestamp):
+        low, high = 0, self._size
+        while low < high:
+            middle = (low + high) // 2
+            if self._timestamps[(self._start + middle) % self.capacity] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _intern(self, value):
+        if value is None:
+            return -1
+        index = self._interned.get(value)
+        if index is None:
+            if self._free:
+                index = self._free.pop()
+                self._ids[index] = value
+            else:
+                index = len(self._ids)
+                self._ids.append(value)
+                self._refs.append(0)
+            self._interned[value] = index
+        self._refs[index] += 1
+        return index
+
+    def _release(self, index):
+        if index == -1:
+            return
+        self._refs[index] -= 1
+        if not self._refs[index]:
+            del self._interned[self._ids[index]]
+            self._ids[index] = None
+            self._free.append(index)
+
+
+class _RecentlyPlayedCache:
+    """
+        Bounded history of the user's recently played items.
+
+        The first refresh downloads the last page of plays. Following refreshes only ask for the plays
+        newer than the 'after' cursor, following the response's next page while there is one, and merge
+        them at the head of the history.
+    """
+    page_size = 50
+
+    def __init__(self, capacity=200, refresh_interval=30):
+        """
+            :param capacity: Maximum number of plays kept in memory.
+            :param refresh_interval: Seconds during which a refresh is skipped without any request.
+        """
+        self.items = deque(maxlen=capacity)
+        self.refresh_interval = refresh_interval
+        self._cursor = None
+        self._refreshed_at = None
+
+    def refresh(self, sp):
+        """
+            Fetches the plays newer than the cursor and merges them into the history.
+
+            :param sp: Spotify client.
+        """
+        now = time.monotonic()
+        if self._refreshed_at is not None and now - self._refreshed_at < self.refresh_interval:
+            return
+        new_items = []
+        while True:
+            after = self._cursor
+            page = self._fetch(sp, after)
+            items = [item for item in page['items'] if self._played_at_ms(item) > (after or 0)]
+            new_items.extend(items)
+            if not items:
+                break
+            cursors = page.get('cursors')
+            if cursors and cursors.get('after'):
+                self._cursor = int(cursors['after'])
+            else:
+                self._cursor = max(self._played_at_ms(item) for item in items)
+            # The first fetch already has the newest plays, there is nothing after them.
+            if after is None or not page.get('next') or len(new_items) >= self.items.maxlen:
+                break
+        self._refreshed_at = now
+        new_items.sort(key=self._played_at_ms)
+        self.items.extendleft(new_items)
+
+    def latest(self, limit):
+        """
+            Returns the newest plays first.
+
+            :param limit: Number of plays to return.
+            :return: List of play history items.
+        """
+        return [self.items[i] for i in range(min(limit, len(self.items)))]
+
+    def _fetch(self, sp, after=None):
+        """
+            Returns a page of recently played items, played after the cursor if it's set.
+        """
+        if after is None:
+            return sp.current_user_recently_played(self.page_size)
+        return sp._get('me/player/recently-played', limit=self.page_size, after=after)
+
+    @staticmethod
+    def _played_at_ms(item):
+        played_at = item['played_at']
+        for fmt in ('%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ'):
+            try:
+                date = datetime.strptime(played_at, fmt).replace(tzinfo=timezone.utc)
+                return int(date.timestamp() * 1000)
+            except ValueError:
+                pass
+        raise ValueError('Unknown played_at format: ' + played_at)
+
+
+class _TopItemsCache:
+    """
+        Caches the user's top tracks and artists with a TTL that depends on the time range.
+
+        The biggest page is always requested so calls with different limits share the same entry.
+    """
+    page_size = 50
+    ttl = {'short_term': 3600, 'medium_term': 6 * 3600, 'long_term': 24 * 3600}
+
+    def __init__(self):
+        self._entries = {}
+
+    def get(self, sp, kind, time_range):
+        """
+            Returns the top items of the user, fetching them only if the cached entry expired.
+
+            :param sp: Spotify client.
+            :param kind: 'tracks' or 'artists'.
+            :param time_range: 'short_term', 'medium_term' or 'long_term'.
+            :return: List of tracks or artists.
+        """
+        key = (kind, time_range)
+        entry = self._entries.get(key)
+        now = time.monotonic()
+        if entry and entry[0] > now:
+            return entry[1]
+        if kind == 'tracks':
+            items = sp.current_user_top_tracks(self.page_size, time_range=time_range)['items']
+        else:
+            items = sp.current_user_top_artists(self.page_size, time_range=time_range)['items']
+        self._entries[key] = (now + self.ttl[time_range], items)
+        return items
+
+
+class _PlaylistIndex:
+    """
+        Local index of the playlists the user owns or follows, matched with trigram similarity.
+
+        Refreshes walk the user's playlists and only re-index the ones whose snapshot_id changed.
+    """
+    page_size = 50
+
+    def __init__(self, refresh_interval=300, threshold=0.5):
+        """
+            :param refresh_interval: Seconds during which the index is used without refreshing it.
+            :param threshold: Minimum similarity, between 0 and 1, to accept a match.
+        """
+        self.refresh_interval = refresh_interval
+        self.threshold = threshold
+        self._playlists = {}
+        self._trigrams = {}
+        self._refreshed_at = None
+
+    def refresh(self, sp):
+        """
+            Updates the index with the current playlists of the user.
+
+            :param sp: Spotify client.
+        """
+        now = time.monotonic()
+        if self._refreshed_at is not None and now - self._refreshed_at < self.refresh_interval:
+            return
+        seen = set()
+        offset = 0
+        while True:
+            page = sp.current_user_playlists(self.page_size, offset)
+            for playlist in page['items']:
+                seen.add(playlist['id'])
+                entry = self._playlists.get(playlist['id'])
+                if entry and entry['snapshot_id'] == playlist['snapshot_id']:
+                    continue
+                if entry:
+                    self._remove(playlist['id'])
+                self._add(playlist)
+            offset += len(page['items'])
+            if not page['next'] or not page['items']:
+                break
+        for playlist_id in list(self._playlists):
+            if playlist_id not in seen:
+                self._remove(playlist_id)
+        self._refreshed_at = now
+
+    def match(self, query):
+        """
+            Returns the URI of the indexed playlist most similar to query.
+
+            :param query: Playlist name to match.
+            :return: Playlist URI, or None if no playlist is similar enough.
+        """
+        name = self._normalize(query)
+        if not name:
+            return None
+        trigrams = self._get_trigrams(name)
+        candidates = {}
+        for trigram in trigrams:
+            for playlist_id in self._trigrams.get(trigram, ()):
+                candidates[playlist_id] = candidates.get(playlist_id, 0) + 1
+        best_uri, best_score = None, 0
+        for playlist_id, shared in candidates.items():
+            entry = self._playlists[playlist_id]
+            if entry['name'] == name:
+                return entry['uri']
+            score = shared / (len(trigrams) + len(entry['trigrams']) - shared)
+            if score > best_score:
+                best_uri, best_score = entry['uri'], score
+        return best_uri if best_score >= self.threshold else None
+
+    def _add(self, playlist):
+        name = self._normalize(playlist['name'])
+        trigrams = self._get_trigrams(name)
+        self._playlists[playlist['id']] = {'uri': playlist['uri'], 'snapshot_id': playlist['snapshot_id'],
+                                           'name': name, 'trigrams': trigrams}
+        for trigram in trigrams:
+            self._trigrams.setdefault(trigram, set()).add(playlist['id'])
+
+    def _remove(self, playlist_id):
+        entry = self._playlists.pop(playlist_id)
+        for trigram in entry['trigrams']:
+            ids = self._trigrams[trigram]
+            ids.discard(playlist_id)
+            if not ids:
+                del self._trigrams[trigram]
+
+    @staticmethod
+    def _normalize(name):
+        name = unicodedata.normalize('NFKD', name or '')
+        name = ''.join(c for c in name if not unicodedata.combining(c))
+        return ' '.join(re.sub(r'[^\w]+', ' ', name.lower()).split())
+
+    @staticmethod
+    def _get_trigrams(name):
+        padded = '  ' + name + ' '
+        return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class _AudioFeaturesStore:
+    """
+        Cache of audio features stored as rows of a float32 matrix, one row per track.
+
+        Features are requested in the biggest batches the API allows and similarity queries are
+        computed over the whole matrix at once.
+    """
+    batch_size = 100
+    features = ('danceability', 'energy', 'valence', 'tempo', 'acousticness', 'instrumentalness',
+                'speechiness', 'liveness', 'loudness')
+    # Brings tempo (BPM) and loudness (dB) differences to the 0-1 range of the other features.
+    _scale = np.array([1, 1, 1, 250, 1, 1, 1, 1, 60], dtype=np.float32)
+
+    def __init__(self, capacity=1024):
+        """
+            :param capacity: Initial number of rows, the matrix grows when it is full.
+        """
+        self._rows = {}
+        self._missing = set()
+        self._matrix = np.empty((capacity, len(self.features)), dtype=np.float32)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def fetch(self, sp, uris):
+        """
+            Downloads the audio features of the tracks that are not stored yet.
+
+            :param sp: Spotify client.
+            :param uris: List of track URIs.
+        """
+        pending = [uri for uri in dict.fromkeys(uris) if uri not in self._rows and uri not in self._missing]
+        for i in range(0, len(pending), self.batch_size):
+            batch = pending[i:i + self.batch_size]
+            for uri, features in zip(batch, sp.audio_features(batch)):
+                if features:
+                    self._add(uri, features)
+                else:
+                    self._missing.add(uri)
+
+    def nearest(self, uri, candidates, limit, tempo_range=None, energy_range=None):
+        """
+            Returns the candidates whose audio features are closest to the ones of uri.
+
+            Tracks must be fetched first. Candidates without features are ignored.
+
+            :param uri: Track URI used as reference.
+            :param candidates: List of track URIs to rank.
+            :param limit: Number of tracks to return.
+            :param tempo_range: Optional (min, max) tempo in BPM that candidates must be in.
+            :param energy_range: Optional (min, max) energy, between 0 and 1, that candidates must be in.
+            :return: List of track URIs, closest first.
+            :raises KeyError: uri has no audio features.
+        """
+        reference = self._matrix[self._rows[uri]]
+        uris = [c for c in dict.fromkeys(candidates) if c in self._rows and c != uri]
+        if not uris or limit <= 0:
+            return []
+        rows = self._matrix[[self._rows[c] for c in uris]]
+        mask = np.ones(len(uris), dtype=bool)
+        for feature, bounds in (('tempo', tempo_range), ('energy', energy_range)):
+            if bounds:
+                column = rows[:, self.features.index(feature)]
+                mask &= (column >= bounds[0]) & (column <= bounds[1])
+        indices = np.flatnonzero(mask)
+        if not len(indices):
+            return []
+        distances = np.square((rows[indices] - reference) / self._scale).sum(axis=1)
+        if limit < len(indices):
+            closest = np.argpartition(distances, limit)[:limit]
+        else:
+            closest = np.arange(len(indices))
+        closest = closest[np.argsort(distances[closest])]
+        return [uris[i] for i in indices[closest]]
+
+    def _add(self, uri, features):
+        if len(self._rows) == len(self._matrix):
+            self._matrix = np.concatenate((self._matrix, np.empty_like(self._matrix)))
+        self._matrix[len(self._rows)] = [features[name] for name in self.features]
+        self._rows[uri] = len(self._rows)
+
+
+class _CatalogCache:
+    """
+        Persistent HTTP cache for catalog endpoints, which almost never change.
+
+        Bodies are stored on disk with their ETag and Last-Modified headers. Fresh entries are served
+        without any request and stale ones are revalidated with If-None-Match and If-Modified-Since,
+        so a 304 response costs no body transfer. The least recently used entries are evicted when
+        the cache is bigger than max_bytes. It can be shared between threads.
+    """
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024):
+        """
+            :param directory: Directory where entries are stored. Created on the first write.
+            :param max_bytes: Maximum size in bytes of the stored entries.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stats = {'hits': 0, 'revalidations': 0, 'misses': 0, 'evictions': 0}
+        self._sizes = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.RLock()
+        entries = []
+        if os.path.isdir(directory):
+            entries = [e for e in os.scandir(directory) if e.name.endswith('.json')]
+        for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+            self._sizes[entry.name] = entry.stat().st_size
+            self._total_bytes += entry.stat().st_size
+        self._evict()
+
+    def get(self, sp, url, **params):
+        """
+            Returns the body of a GET request, from the cache if it's still valid.
+
+            :param sp: Spotify client, whose session and credentials are used.
+            :param url: Endpoint relative to the API prefix, or a full URL.
+            :param params: Query parameters.
+            :return: Decoded JSON body.
+            :raises SpotifyException: The request failed.
+        """
+        if not url.startswith('http'):
+            url = sp.prefix + url
+        params = {k: v for k, v in params.items() if v is not None}
+        key = url + '?' + '&'.join('%s=%s' % item for item in sorted(params.items()))
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json'
+        with self._lock:
+            entry = self._read(name)
+            if entry and entry['expires'] > time.time():
+                self.stats['hits'] += 1
+                self._touch(name)
+                return entry['body']
+        headers = sp._auth_headers()
+        if entry and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        r = self._request(sp, url, headers, params)
+        try:
+            if r.status_code == 304 and entry:
+                entry['expires'] = time.time() + self._get_max_age(r.headers)
+                with self._lock:
+                    self.stats['revalidations'] += 1
+                    self._write(name, entry)
+                return entry['body']
+            entry = {'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified'),
+                     'expires': time.time() + self._get_max_age(r.headers), 'body': r.json()}
+            with self._lock:
+                self.stats['misses'] += 1
+                self._write(name, entry)
+            return entry['body']
+        finally:
+            r.close()
+
+    @staticmethod
+    def _request(sp, url, headers, params):
+        """
+            Sends a GET request, backing off on 429 and 5xx responses the same way spotipy does.
+
+            :return: Response with a status code lower than 400.
+            :raises SpotifyException: The request failed or ran out of retries.
+        """
+        retries = getattr(sp, 'max_get_retries', 10)
+        delay = 1
+        while True:
+            r = sp._session.request('GET', url, headers=headers, params=params, proxies=sp.proxies,
+                                    timeout=sp.requests_timeout)
+            if r.status_code < 400:
+                return r
+            try:
+                message = r.json()['error']['message']
+            except (ValueError, KeyError, TypeError):
+                message = 'error'
+            finally:
+                r.close()
+            retries -= 1
+            if (r.status_code != 429 and not 500 <= r.status_code < 600) or retries <= 0:
+                raise SpotifyException(r.status_code, -1, '%s:\n %s' % (r.url, message), headers=r.headers)
+            time.sleep(int(r.headers.get('Retry-After', delay)))
+            delay += 1
+
+    def get_stats(self):
+        """
+            Returns a copy of the hits, revalidations, misses and evictions counters.
+        """
+        with self._lock:
+            return dict(self.stats)
+
+    def clear(self):
+        """
+            Deletes every stored entry.
+        """
+        with self._lock:
+            for name in list(self._sizes):
+                self._delete(name)
+
+    def _read(self, name):
+        if name not in self._sizes:
+            return None
+        try:
+            with open(os.path.join(self.directory, name), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            self._delete(name)
+            return None
+
+    def _write(self, name, entry):
+        data = json.dumps(entry).encode('utf-8')
+        if len(data) > self.max_bytes:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, name), 'wb') as f:
+            f.write(data)
+        self._total_bytes += len(data) - self._sizes.pop(name, 0)
+        self._sizes[name] = len(data)
+        self._evict()
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes:
+            self._delete(next(iter(self._sizes)))
+            self.stats['evictions'] += 1
+
+    def _touch(self, name):
+        self._sizes.move_to_end(name)
+        try:
+            os.utime(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def _delete(self, name):
+        self._total_bytes -= self._sizes.pop(name, 0)
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    @staticmethod
+    def _get_max_age(headers):
+        match = re.search(r'max-age=(\d+)', headers.get('Cache-Control', ''))
+        return int(match.group(1)) if match else 0
+
+
+def _longest_common_subsequence(a, b):
+    """
+        Returns the longest common subsequence of two lists as (index in a, index in b) pairs.
+
+        Uses Hunt-Szymanski, which is fast when elements are mostly unique, as songs in a playlist.
+    """
+    positions = {}
+    for j, element in enumerate(b):
+        positions.setdefault(element, []).append(j)
+    tails, links = [], []
+    for i, element in enumerate(a):
+        for j in reversed(positions.get(element, ())):
+            k = bisect_left(tails, j)
+            link = (i, j, links[k - 1] if k else None)
+            if k == len(tails):
+                tails.append(j)
+                links.append(link)
+            else:
+                tails[k] = j
+                links[k] = link
+    pairs = []
+    link = links[-1] if links else None
+    while link:
+        pairs.append(link[:2])
+        link = link[2]
+    pairs.reverse()
+    return pairs
+
+
+class _PlayQueue:
+    """
+        Client side play queue for songs that don't fit in a single start_playback call.
+
+        The first songs are played as a regular uris context. The rest are resolved in a background
+        thread and added to the device's queue once the last song of the context is playing, keeping
+        `ahead` of them queued after the one playing, so at most that many are left in the queue if the
+        user plays something else. Playback is checked once per song, less often while it's paused, and
+        right after wake() is called. The thread stops when the songs run out, playback stays paused for
+        idle_timeout seconds or the user plays something else.
+    """
+    context_size = 100
+    ahead = 2
+
+    def __init__(self, sp, uris, pending=None, device_id=None, max_interval=300, idle_timeout=3600):
+        """
+            :param sp: Spotify client.
+            :param uris: List of song URIs. The first context_size are played as a context.
+            :param pending: Optional iterable of more song URIs, which can be lazily resolved.
+            :param device_id: Device target, if it's not set, target is current device.
+            :param max_interval: Maximum seconds between playback checks while it's paused.
+            :param idle_timeout: Seconds paused after which the queue stops.
+        """
+        self.sp = sp
+        self.device_id = device_id
+        self.max_interval = max_interval
+        self.idle_timeout = idle_timeout
+        self.context = list(uris[:self.context_size])
+        self._has_pending = len(uris) > self.context_size or pending is not None
+        self._pending = chain(uris[self.context_size:], pending or ())
+        self._stopped = threading.Event()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """
+            Plays the first songs and, if there are more, starts adding them in the background.
+
+            :raises IndexError: There is no results.
+        """
+        if not self.context:
+            raise IndexError('There is no results.')
+        self.sp.start_playback(uris=self.context, device_id=self.device_id)
+        if self._has_pending:
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+
+    def wake(self):
+        """
+            Checks playback again shortly, for when the user moves it to another song.
+        """
+        self._wake.set()
+
+    def _run(self):
+        sent = set(self.context)
+        positions = {}
+        queued = 0
+        wait = 1
+        paused = 0
+        try:
+            while True:
+                if self._wake.wait(wait):
+                    self._wake.clear()
+                    if self._stopped.is_set():
+                        return
+                    # Gives Spotify a moment to apply the change before checking it.
+                    wait = 1
+                    paused = 0
+                    continue
+                status = self.sp.currently_playing()
+                item = status['item'] if status else None
+                if not item or item['uri'] not in sent:
+                    logger.info('Play queue stopped, playback moved to a song outside of it.')
+                    return
+                if not status['is_playing']:
+                    paused += wait
+                    if paused >= self.idle_timeout:
+                        logger.info('Play queue stopped, playback was paused for %ss.', self.idle_timeout)
+                        return
+                    wait = min(wait * 2, self.max_interval)
+                    continue
+                paused = 0
+                if item['uri'] in positions:
+                    ahead = queued - 1 - positions[item['uri']]
+                elif item['uri'] == self.context[-1]:
+                    ahead = queued
+                else:
+                    ahead = self.ahead
+                while ahead < self.ahead:
+                    uri = next(self._pending, None)
+                    if uri is None:
+                        break
+                    self.sp._post('me/player/queue', uri=uri, device_id=self.device_id)
+                    sent.add(uri)
+                    positions[uri] = queued
+                    queued += 1
+                    ahead += 1
+                if not ahead:
+                    return
+                wait = max(item['duration_ms'] - status['progress_ms'], 0) / 1000 + 1
+        except Exception:
+            logger.warning('Play queue stopped adding songs after an error.', exc_info=True)
+        finally:
+            self._stopped.set()
+
+
+class _CircuitBreaker:
+    """
+        Circuit breaker of a single device, safe to share between threads.
+
+        It opens after threshold consecutive device errors. While open, calls fail without any request
+        until cooldown seconds pass, then it's half-open and lets a single call through if the device
+        is listed again. Success closes it and any error opens it again.
+    """
+
+    def __init__(self, threshold=3, cooldown=30):
+        """
+            :param threshold: Consecutive device errors needed to open the breaker.
+            :param cooldown: Seconds the breaker stays open before probing the device.
+        """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def depth(self):
+        """
+            Number of nested calls of the current thread through the breaker.
+        """
+        return getattr(self._local, 'depth', 0)
+
+    @depth.setter
+    def depth(self, value):
+        self._local.depth = value
+
+    def allow(self):
+        """
+            Checks if a call can go through, moving an open breaker to half-open after the cooldown.
+
+            :return: 'call', 'probe' if the device must be checked first, or None if it must fail.
+        """
+        with self._lock:
+            if self.state == 'closed':
+                return 'call'
+            if self.state == 'open' and time.monotonic() - self._opened_at >= self.cooldown:
+                self.state = 'half-open'
+                return 'probe'
+            return None
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half-open' or self.failures >= self.threshold:
+                self._trip()
+
+    def end_probe(self):
+        """
+            Opens the breaker again if the probing call ended without closing it.
+        """
+        with self._lock:
+            if self.state == 'half-open':
+                self._trip()
+
+    def _trip(self):
+        self.state = 'open'
+        self._opened_at = time.monotonic()
+
 
 class SpotifyManager:
-    def __init__(self, username, client_id, client_secret, redirect_uri):
+    def __init__(self, username, client_id, client_secret, redirect_uri, catalog_cache_dir=None,
+                 catalog_cache_size=64 * 1024 * 1024, token=None, history_size=10000):
         """
             Create a SpotifyManager object.
 
@@ -11,12 +866,45 @@ class SpotifyManager:
             :param client_id: The client id of your app.
             :param client_secret: The client secret of your app.
             :param redirect_uri: The redirect URI of your app.
-        """
-        scope = 'playlist-read-private playlist-read-collaborative streaming user-library-read ' \
-                'user-library-modify user-read-private user-top-read user-read-playback-state ' \
-                'user-modify-playback-state user-read-currently-playing user-read-recently-played'
-        token = util.prompt_for_user_token(username, scope, client_id, client_secret, redirect_uri)
+            :param catalog_cache_dir: Directory where album and artist data is cached. If it's not set,
+                                      '.catalog-cache-' + username is used.
+            :param catalog_cache_size: Maximum size in bytes of the catalog cache.
+            :param token: Access token to use. If it's not set, it's requested to the user.
+            :param history_size: Maximum number of plays kept on history. 0 to disable it.
+        """
+        if not token:
+            scope = 'playlist-read-private playlist-read-collaborative streaming user-library-read ' \
+                    'user-library-modify user-read-private user-top-read user-read-playback-state ' \
+                    'user-modify-playback-state user-read-currently-playing user-read-recently-played'
+            token = util.prompt_for_user_token(username, scope, client_id, client_secret, redirect_uri)
         self.sp = Spotify(auth=token)
+        self.username = username
+        self._recently_played = _RecentlyPlayedCache()
+        self._top_items = _TopItemsCache()
+        self._playlist_index = _PlaylistIndex()
+        self._audio_features = _AudioFeaturesStore()
+        self._saved_tracks = None
+        self._saved_tracks_refreshed_at = None
+        catalog_cache_dir = catalog_cache_dir or '.catalog-cache-' + username
+        self._catalog_cache = _CatalogCache(catalog_cache_dir, catalog_cache_size)
+        self._play_queue = None
+        self._breakers = {}
+        self.history = PlaybackHistory(history_size) if history_size else None
+
+    # Devices
+
+    def get_device_state(self, device_id=None):
+        """
+            Gets the state of the device's circuit breaker.
+
+            After repeated errors a device is considered unreachable and calls to it fail without
+            any request until a later check finds it available again.
+
+            :param device_id: Device target, if it's not set, target is current device.
+            :return: Breaker state, which can be 'closed', 'open' or 'half-open'.
+        """
+        breaker = self._breakers.get(device_id)
+        return breaker.state if breaker else 'closed'
 
     # Volume
 
@@ -31,12 +919,13 @@ class SpotifyManager:
         """
         if not isinstance(volume_percent, int):
             raise TypeError('volume_percent is not an integer')
-        volume = self.get_volume(device_id) + volume_percent
-        if volume > 100:
-            volume = 100
-        elif volume < 0:
-            volume = 0
-        self.set_volume(volume, device_id)
+        with self._device_breaker(device_id):
+            volume = self.get_volume(device_id) + volume_percent
+            if volume > 100:
+                volume = 100
+            elif volume < 0:
+                volume = 0
+            self.set_volume(volume, device_id)
 
     def decrease_volume(self, volume_percent, device_id=None):
         """
@@ -64,17 +953,18 @@ class SpotifyManager:
         """
         if not isinstance(volume_percent, int):
             raise TypeError('volume_percent is not an integer')
-        if volume_percent > 100:
-            volume_percent = 100
-        elif volume_percent < 0:
-            volume_percent = 0
-        try:
-            self.sp.volume(int(volume_percent), device_id)
-        except SpotifyException as se:
-            if se.http_status == 403:
-                raise ConnectionError('There is no active device or device_id is not valid.')
-            else:
-                raise
+        with self._device_breaker(device_id):
+            if volume_percent > 100:
+                volume_percent = 100
+            elif volume_percent < 0:
+                volume_percent = 0
+            try:
+                self.sp.volume(int(volume_percent), device_id)
+            except SpotifyException as se:
+                if se.http_status == 403:
+                    raise ConnectionError('There is no active device or device_id is not valid.')
+                else:
+                    raise
 
     def get_volume(self, device_id=None):
         """
@@ -83,11 +973,12 @@ class SpotifyManager:
             :param device_id: Device target, if it's not set, target is current device.
             :raises ConnectionError: There is no active device or device_id is not valid.
         """
-        if device_id:
-            dev = self._get_device(device_id)
-        else:
-            dev = self._get_active_device()
-        return dev['volume_percent']
+        with self._device_breaker(device_id):
+            if device_id:
+                dev = self._get_device(device_id)
+            else:
+                dev = self._get_active_device()
+            return dev['volume_percent']
 
     # Get info
 
@@ -101,6 +992,7 @@ class SpotifyManager:
         status = self.sp.currently_playing()
         if not status:
             raise ConnectionError('User not connected to Spotify ')
+        self._record_playback(status)
         return status['item']
 
     def get_current_album_info(self):
@@ -112,6 +1004,22 @@ class SpotifyManager:
         """
         return self.get_current_song_info()['album']
 
+    def get_catalog_cache_stats(self):
+        """
+            Gets hits, revalidations, misses and evictions of the album and artist data cache.
+
+            Hits are served without any request and revalidations by a response without body.
+
+            :return: Dictionary.
+        """
+        return self._catalog_cache.get_stats()
+
+    def clear_catalog_cache(self):
+        """
+            Deletes every album and artist data stored in the cache.
+        """
+        self._catalog_cache.clear()
+
     def get_current_song_artist(self):
 
         """
@@ -147,16 +1055,17 @@ class SpotifyManager:
             :param device_id: Device target, if it's not set, target is current device.
             :raises ConnectionError: There is no active device or device_id is not valid.
         """
-        try:
-            self.sp.start_playback(device_id)
-        except SpotifyException as se:
-            if se.http_status == 404:
-                raise ConnectionError('There is no active device or device_id is not valid.')
-            # Err 403 - Not paused
-            elif se.http_status == 403 and 'Forbidden' in se.msg:
-                raise ConnectionError('There is no active device or device_id is not valid.')
-            else:
-                raise
+        with self._device_breaker(device_id):
+            try:
+                self.sp.start_playback(device_id)
+            except SpotifyException as se:
+                if se.http_status == 404:
+                    raise ConnectionError('There is no active device or device_id is not valid.')
+                # Err 403 - Not paused
+                elif se.http_status == 403 and 'Forbidden' in se.msg:
+                    raise ConnectionError('There is no active device or device_id is not valid.')
+                else:
+                    raise
 
     def pause(self, device_id=None):
         """
@@ -167,16 +1076,17 @@ class SpotifyManager:
             :param device_id: Device target, if it's not set, target is current device.
             :raises ConnectionError: There is no active device or device_id is not valid.
         """
-        try:
-            self.sp.pause_playback(device_id)
-        except SpotifyException as se:
-            if se.http_status == 404:
-                raise ConnectionError('There is no active device or device_id is not valid.')
-            # Err 403 - Not paused
-            elif se.http_status == 403 and 'Forbidden' in se.msg:
-                raise ConnectionError('There is no active device or device_id is not valid.')
-            else:
-                raise
+        with self._device_breaker(device_id):
+            try:
+                self.sp.pause_playback(device_id)
+            except SpotifyException as se:
+                if se.http_status == 404:
+                    raise ConnectionError('There is no active device or device_id is not valid.')
+                # Err 403 - Not paused
+                elif se.http_status == 403 and 'Forbidden' in se.msg:
+                    raise ConnectionError('There is no active device or device_id is not valid.')
+                else:
+                    raise
 
     def switch_play_pause(self, device_id=None):
         """
@@ -187,19 +1097,21 @@ class SpotifyManager:
             :param device_id: Device target, if it's not set, target is current device.
             :raises ConnectionError: There is no active device or device_id is not valid.
         """
-        try:
-            self.sp.start_playback(device_id)
-        except SpotifyException as se:
-            # Err 403 - Not paused
-            if se.http_status == 403:
-                if 'Forbidden' not in se.msg:
-                    self.sp.pause_playback(device_id)
-                else:
+        with self._device_breaker(device_id):
+            try:
+                self.sp.start_playback(device_id)
+            except SpotifyException as se:
+                # Err 403 - Not paused
+                if se.http_status == 403:
+                    if 'Forbidden' not in se.msg:
+                        self.sp.pause_playback(device_id)
+                    else:
+                        raise ConnectionError('There is no active device or device_id is not valid.')
+                elif se.http_status == 404:
                     raise ConnectionError('There is no active device or device_id is not valid.')
-            elif se.http_status == 404:
-                raise ConnectionError('There is no active device or device_id is not valid.')
-            else:
-                raise
+                else:
+                    raise
+        self._wake_queue()
 
     def next_song(self, device_id=None):
         """
@@ -210,13 +1122,15 @@ class SpotifyManager:
             :param device_id: Device target, if it's not set, target is current device.
             :raises ConnectionError: There is no active device or device_id is not valid.
         """
-        try:
-            self.sp.next_track(device_id)
-        except SpotifyException as se:
-            if se.http_status == 404 or se.http_status == 403:
-                raise ConnectionError('There is no active device or device_id is not valid.')
-            else:
-                raise
+        with self._device_breaker(device_id):
+            try:
+                self.sp.next_track(device_id)
+            except SpotifyException as se:
+                if se.http_status == 404 or se.http_status == 403:
+                    raise ConnectionError('There is no active device or device_id is not valid.')
+                else:
+                    raise
+        self._wake_queue()
 
     def previous_song(self, restart_time=0, device_id=None):
         """
@@ -233,22 +1147,24 @@ class SpotifyManager:
         """
         if not isinstance(restart_time, int):
             raise TypeError('restart_time is not an integer')
-        if restart_time != 0 and self.sp.currently_playing()['progress_ms']/1000 > restart_time:
-                self.restart_song(device_id)
-        else:
-            try:
-                self.sp.previous_track(device_id)
-            except SpotifyException as se:
-                # Err 403 - No previous track
-                if se.http_status == 403:
-                    if 'Forbidden' not in se.msg:
-                        self.restart_song(device_id)
-                    else:
+        with self._device_breaker(device_id):
+            if restart_time != 0 and self.sp.currently_playing()['progress_ms']/1000 > restart_time:
+                    self.restart_song(device_id)
+            else:
+                try:
+                    self.sp.previous_track(device_id)
+                except SpotifyException as se:
+                    # Err 403 - No previous track
+                    if se.http_status == 403:
+                        if 'Forbidden' not in se.msg:
+                            self.restart_song(device_id)
+                        else:
+                            raise ConnectionError('There is no active device or device_id is not valid.')
+                    elif se.http_status == 404:
                         raise ConnectionError('There is no active device or device_id is not valid.')
-                elif se.http_status == 404:
-                    raise ConnectionError('There is no active device or device_id is not valid.')
-                else:
-                    raise
+                    else:
+                        raise
+        self._wake_queue()
 
     def restart_song(self, device_id=None):
         """
@@ -259,13 +1175,14 @@ class SpotifyManager:
             :param device_id: Device target, if it's not set, target is current device.
             :raises ConnectionError: There is no active device or device_id is not valid.
         """
-        try:
-            self.sp.seek_track(0, device_id)
-        except SpotifyException as se:
-            if se.http_status == 404 or se.http_status == 403:
-                raise ConnectionError('There is no active device or device_id is not valid.')
-            else:
-                raise
+        with self._device_breaker(device_id):
+            try:
+                self.sp.seek_track(0, device_id)
+            except SpotifyException as se:
+                if se.http_status == 404 or se.http_status == 403:
+                    raise ConnectionError('There is no active device or device_id is not valid.')
+                else:
+                    raise
 
     # Repeat & Shuffle
 
@@ -277,7 +1194,9 @@ class SpotifyManager:
             :raises ConnectionError: User is not connected to Spotify.
         """
         try:
-            return self.sp.current_playback()['repeat_state']
+            status = self.sp.current_playback()
+            self._record_playback(status)
+            return status['repeat_state']
         except TypeError:
             raise ConnectionError('User is not connected to Spotify.')
 
@@ -294,13 +1213,14 @@ class SpotifyManager:
         """
         if repeat_state not in ['track', 'context', 'off']:
             raise TypeError('repeat_state must be \'track\', \'context\' or \'off\'.')
-        try:
-            self.sp.repeat(repeat_state, device_id)
-        except SpotifyException as se:
-            if se.http_status == 404:
-                raise ConnectionError('There is no active device or device_id is not valid.')
-            else:
-                raise
+        with self._device_breaker(device_id):
+            try:
+                self.sp.repeat(repeat_state, device_id)
+            except SpotifyException as se:
+                if se.http_status == 404:
+                    raise ConnectionError('There is no active device or device_id is not valid.')
+                else:
+                    raise
 
     def next_repeat_state(self, device_id=None):
         """
@@ -328,7 +1248,9 @@ class SpotifyManager:
             :raises ConnectionError: User is not connected to Spotify.
         """
         try:
-            return self.sp.current_playback()['shuffle_state']
+            status = self.sp.current_playback()
+            self._record_playback(status)
+            return status['shuffle_state']
         except TypeError:
             raise ConnectionError('User is not connected to Spotify.')
 
@@ -345,13 +1267,14 @@ class SpotifyManager:
         """
         if shuffle_state not in [True, False]:
             raise TypeError('shuffle_state must be True or False.')
-        try:
-            self.sp.shuffle(shuffle_state, device_id)
-        except SpotifyException as se:
-            if se.http_status == 404:
-                raise ConnectionError('There is no active device or device_id is not valid.')
-            else:
-                raise
+        with self._device_breaker(device_id):
+            try:
+                self.sp.shuffle(shuffle_state, device_id)
+            except SpotifyException as se:
+                if se.http_status == 404:
+                    raise ConnectionError('There is no active device or device_id is not valid.')
+                else:
+                    raise
 
     def switch_shuffle_state(self, device_id=None):
         """
@@ -378,6 +1301,7 @@ class SpotifyManager:
         """
         try:
             uri = self.sp.search(song_name, 1, type='track')['tracks']['items'][0]['uri']
+            self.stop_queue()
             self.sp.start_playback(uris=[uri], device_id=device_id)
         except SpotifyException as se:
             if se.http_status == 400 and 'No search query' in se.msg:
@@ -403,6 +1327,7 @@ class SpotifyManager:
         """
         try:
             uri = self.sp.search(album_name, 1, type='album')['albums']['items'][0]['uri']
+            self.stop_queue()
             self.sp.start_playback(context_uri=uri, device_id=device_id)
             self.set_shuffle_state(False, device_id)
         except SpotifyException as se:
@@ -429,6 +1354,7 @@ class SpotifyManager:
         """
         try:
             uri = self.sp.search(artist_name, 1, type='artist')['artists']['items'][0]['uri']
+            self.stop_queue()
             self.sp.start_playback(context_uri=uri, device_id=device_id)
         except SpotifyException as se:
             if se.http_status == 400 and 'No search query' in se.msg:
@@ -462,7 +1388,7 @@ class SpotifyManager:
                 uris = []
                 for track in results:
                     uris.append(track['uri'])
-                self.sp.start_playback(uris=uris, device_id=device_id)
+                self._start_queue(uris, device_id)
         except SpotifyException as se:
             if se.http_status == 404:
                 raise ConnectionError('device_id is not valid.')
@@ -473,6 +1399,9 @@ class SpotifyManager:
         """
             Search playlist that matches playlist_name and plays it.
 
+            The user's own and followed playlists are matched locally first. Spotify's catalog is only
+            searched if none of them is similar enough.
+
             Doesn't throw an error if there is no active device.
 
             :param playlist_name: Query to match.
@@ -482,7 +1411,11 @@ class SpotifyManager:
             :raises IndexError: There is no results.
         """
         try:
-            uri = self.sp.search(playlist_name, 1, type='playlist')['playlists']['items'][0]['uri']
+            self._playlist_index.refresh(self.sp)
+            uri = self._playlist_index.match(playlist_name)
+            if not uri:
+                uri = self.sp.search(playlist_name, 1, type='playlist')['playlists']['items'][0]['uri']
+            self.stop_queue()
             self.sp.start_playback(context_uri=uri, device_id=device_id)
         except SpotifyException as se:
             if se.http_status == 400 and 'No search query' in se.msg:
@@ -512,31 +1445,69 @@ class SpotifyManager:
                 artists.append(artist['uri'])
             for track in self.sp.recommendations(seed_artists=artists, limit=limit)['tracks']:
                 uris.append(track['uri'])
-            self.sp.start_playback(uris=uris, device_id=device_id)
+            self._start_queue(uris, device_id)
         except SpotifyException as se:
             if se.http_status == 404:
                 raise ConnectionError('device_id is not valid.')
             else:
                 raise
 
-    def play_similar_from_current_track(self, limit=20, device_id=None):
+    def play_similar_from_current_track(self, limit=20, device_id=None, tempo_range=None, energy_range=None):
         """
             Search songs similar to the current one and play them.
 
+            If tempo_range or energy_range are set, the biggest batch of recommendations is filtered and
+            ranked locally by its audio features.
+
             :param limit: Number of songs to search and play.
             :param device_id: Device target, if it's not set, target is current device.
+            :param tempo_range: Optional (min, max) tempo in BPM of the songs to play.
+            :param energy_range: Optional (min, max) energy, between 0 and 1, of the songs to play.
             :raises ConnectionError: There is no active device or device_id is not valid. Also User is
                                      not connected to Spotify.
             :raises TypeError: limit is not an integer.
+            :raises IndexError: There is no results.
         """
         if not isinstance(limit, int):
             raise TypeError('limit must be an integer.')
         try:
             song_uri = self.get_current_song_info()['uri']
             uris = []
-            for track in self.sp.recommendations(seed_tracks=[song_uri], limit=limit)['tracks']:
-                uris.append(track['uri'])
-            self.sp.start_playback(uris=uris, device_id=device_id)
+            if tempo_range or energy_range:
+                for track in self.sp.recommendations(seed_tracks=[song_uri], limit=100)['tracks']:
+                    uris.append(track['uri'])
+                uris = self._rank_similar(song_uri, uris, limit, tempo_range, energy_range)
+            else:
+                for track in self.sp.recommendations(seed_tracks=[song_uri], limit=limit)['tracks']:
+                    uris.append(track['uri'])
+            self._start_queue(uris, device_id)
+        except SpotifyException as se:
+            if se.http_status == 404:
+                raise ConnectionError('device_id is not valid.')
+            else:
+                raise
+
+    def play_similar_from_library(self, limit=20, device_id=None, tempo_range=None, energy_range=None):
+        """
+            Search songs of user's library similar to the current one and play them.
+
+            Songs are ranked locally by their audio features, which are cached between calls.
+
+            :param limit: Number of songs to search and play.
+            :param device_id: Device target, if it's not set, target is current device.
+            :param tempo_range: Optional (min, max) tempo in BPM of the songs to play.
+            :param energy_range: Optional (min, max) energy, between 0 and 1, of the songs to play.
+            :raises ConnectionError: There is no active device or device_id is not valid. Also User is
+                                     not connected to Spotify.
+            :raises TypeError: limit is not an integer.
+            :raises IndexError: There is no results.
+        """
+        if not isinstance(limit, int):
+            raise TypeError('limit must be an integer.')
+        try:
+            song_uri = self.get_current_song_info()['uri']
+            uris = self._rank_similar(song_uri, self._get_saved_tracks(), limit, tempo_range, energy_range)
+            self._start_queue(uris, device_id)
         except SpotifyException as se:
             if se.http_status == 404:
                 raise ConnectionError('device_id is not valid.')
@@ -547,6 +1518,8 @@ class SpotifyManager:
         """
             Search songs that user played recently.
 
+            Plays are cached and only the new ones are requested on later calls.
+
             :param limit: Number of songs to search and play.
             :param device_id: Device target, if it's not set, target is current device.
             :raises ConnectionError: There is no active device or device_id is not valid. Also User is
@@ -557,57 +1530,70 @@ class SpotifyManager:
             raise TypeError('limit must be an integer.')
         try:
             uris = []
-            for track in self.sp.current_user_recently_played(limit)['items']:
+            self._recently_played.refresh(self.sp)
+            for track in self._recently_played.latest(limit):
                 uris.append(track['track']['uri'])
-            self.sp.start_playback(uris=uris, device_id=device_id)
+            self._start_queue(uris, device_id)
         except SpotifyException as se:
             if se.http_status == 404:
                 raise ConnectionError('device_id is not valid.')
             else:
                 raise
 
-    def play_top_tracks(self, limit=20, device_id=None):
+    def play_top_tracks(self, limit=20, device_id=None, time_range='medium_term'):
         """
             Search songs that user plays the most and plays them.
 
-            :param limit: Number of songs to search and play.
+            Top tracks are cached for a period that depends on time_range.
+
+            :param limit: Number of songs to search and play, up to 50.
             :param device_id: Device target, if it's not set, target is current device.
+            :param time_range: Time range, which can be 'short_term', 'medium_term' or 'long_term'.
             :raises ConnectionError: There is no active device or device_id is not valid. Also User is
                                      not connected to Spotify.
-            :raises TypeError: limit or offset are not an integer.
+            :raises TypeError: limit is not an integer between 1 and 50. Also time_range is not valid.
         """
         if not isinstance(limit, int):
             raise TypeError('limit must be an integer.')
+        if not 1 <= limit <= _TopItemsCache.page_size:
+            raise TypeError('limit must be between 1 and 50.')
+        if time_range not in ['short_term', 'medium_term', 'long_term']:
+            raise TypeError('time_range must be \'short_term\', \'medium_term\' or \'long_term\'.')
         try:
             uris = []
-            for track in self.sp.current_user_top_tracks(limit)['items']:
+            for track in self._top_items.get(self.sp, 'tracks', time_range)[:limit]:
                 uris.append(track['uri'])
-            self.sp.start_playback(uris=uris, device_id=device_id)
+            self._start_queue(uris, device_id)
         except SpotifyException as se:
             if se.http_status == 404:
                 raise ConnectionError('device_id is not valid.')
             else:
                 raise
 
-    def play_top_artists(self, limit=5, device_id=None):
+    def play_top_artists(self, limit=5, device_id=None, time_range='medium_term'):
         """
-            Search top songs from artists that user plays the most and plays them.
+            Search top songs from artists that user plays the most and plays them shuffled.
 
-            :param limit: Number of artists to analyze.
+            Top artists are cached for a period that depends on time_range. Songs of the first artist
+            start playing while the ones of the rest are resolved.
+
+            :param limit: Number of artists to analyze, up to 50.
             :param device_id: Device target, if it's not set, target is current device.
+            :param time_range: Time range, which can be 'short_term', 'medium_term' or 'long_term'.
             :raises ConnectionError: There is no active device or device_id is not valid. Also User is
                                      not connected to Spotify.
-            :raises TypeError: limit or offset are not an integer.
+            :raises TypeError: limit is not an integer between 1 and 50. Also time_range is not valid.
         """
         if not isinstance(limit, int):
             raise TypeError('limit must be an integer.')
+        if not 1 <= limit <= _TopItemsCache.page_size:
+            raise TypeError('limit must be between 1 and 50.')
+        if time_range not in ['short_term', 'medium_term', 'long_term']:
+            raise TypeError('time_range must be \'short_term\', \'medium_term\' or \'long_term\'.')
         try:
-            uris = []
-            for artist in self.sp.current_user_top_artists(limit)['items']:
-                for track in self.sp.artist_top_tracks(artist['uri'])['tracks']:
-                    uris.append(track['uri'])
-            self.sp.start_playback(uris=uris, device_id=device_id)
-            self.set_shuffle_state(True)
+            artists = self._top_items.get(self.sp, 'artists', time_range)[:limit]
+            uris = list(self._get_shuffled_top_tracks(artists[:1]))
+            self._start_queue(uris, device_id, self._get_shuffled_top_tracks(artists[1:]))
         except SpotifyException as se:
             if se.http_status == 404:
                 raise ConnectionError('device_id is not valid.')
@@ -638,7 +1624,7 @@ class SpotifyManager:
 
         :raises ConnectionError: User is not connected to Spotify
         """
-        self.sp.current_user_saved_albums_add([self.get_current_album_info()['uri']])
+        self.sp.current_user_saved_albums_add([self.get_current_song_info()['album']['uri']])
 
     def delete_current_album(self):
         """
@@ -647,9 +1633,259 @@ class SpotifyManager:
         :raises ConnectionError: User is not connected to Spotify
         """
         uris = []
-        for track in self.sp.album_tracks(self.get_current_album_info()['uri'])['items']:
-            uris.append(track['uri'])
-        self.sp.current_user_saved_tracks_delete(uris)
+        album_id = self.get_current_song_info()['album']['uri'].split(':')[-1]
+        page = self._catalog_cache.get(self.sp, 'albums/%s/tracks' % album_id, limit=50)
+        while page:
+            for track in page['items']:
+                uris.append(track['uri'])
+            page = self._catalog_cache.get(self.sp, page['next']) if page['next'] else None
+        for i in range(0, len(uris), 50):
+            self.sp.current_user_saved_tracks_delete(uris[i:i + 50])
+
+    # Sync
+
+    def sync_playlist(self, playlist_id, desired_uris):
+        """
+            Makes a playlist contain exactly desired_uris, in the same order.
+
+            Only the songs that are not part of the longest common subsequence between the playlist and
+            desired_uris are removed and inserted, in batches of 100 chained by snapshot_id. If that
+            takes more requests than rewriting the playlist, it's rewritten instead.
+
+            Local files and unavailable items can't be removed through the API, so they are kept where
+            they are and the desired songs are placed around them.
+
+            :param playlist_id: Playlist ID, URI or URL.
+            :param desired_uris: List of song URIs.
+            :return: Snapshot ID of the playlist after the sync.
+            :raises RuntimeError: The playlist kept changing while its items were read.
+        """
+        snapshot_id, current = self._get_playlist_items(playlist_id)
+        pairs = _longest_common_subsequence(current, desired_uris)
+        kept = dict(pairs)
+        removals = [i for i in range(len(current)) if i not in kept and current[i] is not None]
+        kept_desired = set(kept.values())
+        insertions = []
+        for j in range(len(desired_uris)):
+            if j in kept_desired:
+                continue
+            if insertions:
+                start, uris = insertions[-1]
+                if start + len(uris) == j and len(uris) < 100:
+                    uris.append(desired_uris[j])
+                    continue
+            insertions.append((j, [desired_uris[j]]))
+
+        removal_batches = (len(removals) + 99) // 100
+        rewrite_batches = max(1, (len(desired_uris) + 99) // 100)
+        if None not in current and removal_batches + len(insertions) > rewrite_batches:
+            result = self.sp.user_playlist_replace_tracks(self.username, playlist_id, desired_uris[:100])
+            for i in range(100, len(desired_uris), 100):
+                result = self.sp.user_playlist_add_tracks(self.username, playlist_id, desired_uris[i:i + 100])
+            return result['snapshot_id']
+
+        # Highest positions first, so the ones of the next batches are still valid.
+        removals.reverse()
+        for i in range(0, len(removals), 100):
+            tracks = OrderedDict()
+            for position in removals[i:i + 100]:
+                tracks.setdefault(current[position], []).append(position)
+            tracks = [{'uri': uri, 'positions': positions} for uri, positions in tracks.items()]
+            snapshot_id = self.sp.user_playlist_remove_specific_occurrences_of_tracks(
+                self.username, playlist_id, tracks, snapshot_id)['snapshot_id']
+        # Index in desired_uris of every item left, None for the ones that can't be removed.
+        layout = [kept.get(i) for i in range(len(current)) if i in kept or current[i] is None]
+        # Lowest positions first, so the song before each insertion is already in place.
+        for start, uris in insertions:
+            position = layout.index(start - 1) + 1 if start else 0
+            result = self.sp.user_playlist_add_tracks(self.username, playlist_id, uris, position)
+            snapshot_id = result['snapshot_id']
+            layout[position:position] = range(start, start + len(uris))
+        return snapshot_id
+
+    def _get_playlist_items(self, playlist_id, attempts=3):
+        """
+            Returns the snapshot ID of a playlist and the URIs of its items.
+
+            The first page of items comes with the snapshot ID. If there are more pages, the snapshot ID
+            is checked again after reading them and everything is read again if it changed.
+
+            :param playlist_id: Playlist ID, URI or URL.
+            :param attempts: Maximum number of times the playlist is read.
+            :return: (snapshot_id, [uri, ...]), with None for local files and unavailable items.
+            :raises RuntimeError: The playlist changed on every attempt.
+        """
+        fields = 'snapshot_id,tracks.items(track(uri,is_local)),tracks.next'
+        for _ in range(attempts):
+            playlist = self.sp.user_playlist(self.username, playlist_id, fields=fields)
+            uris = []
+            page = playlist['tracks']
+            while page:
+                for item in page['items']:
+                    track = item['track']
+                    uris.append(track['uri'] if track and not track.get('is_local') else None)
+                page = self.sp.next(page)
+            if not playlist['tracks']['next']:
+                return playlist['snapshot_id'], uris
+            current = self.sp.user_playlist(self.username, playlist_id, fields='snapshot_id')
+            if current['snapshot_id'] == playlist['snapshot_id']:
+                return playlist['snapshot_id'], uris
+        raise RuntimeError('Playlist changed while its items were read.')
+
+    def stop_queue(self):
+        """
+            Stops adding songs of the last play_* call to the device's queue.
+
+            Spotify doesn't allow removing songs from the queue, so the songs already added, at most
+            two, are still played.
+        """
+        if self._play_queue:
+            self._play_queue.stop()
+            self._play_queue = None
+
+    def _wake_queue(self):
+        """
+            Lets the play queue, if any, check playback after the user moved it.
+        """
+        play_queue = self._play_queue
+        if play_queue:
+            play_queue.wake()
+
+    def _start_queue(self, uris, device_id=None, pending=None):
+        """
+            Plays uris and adds the songs that don't fit in a context to the device's queue in the
+            background.
+
+            :param uris: List of song URIs.
+            :param device_id: Device target, if it's not set, target is current device.
+            :param pending: Optional iterable of songs to play after uris, which can be lazily resolved.
+            :raises IndexError: There is no results.
+        """
+        self.stop_queue()
+        self._play_queue = _PlayQueue(self.sp, uris, pending, device_id)
+        self._play_queue.start()
+
+    def _get_shuffled_top_tracks(self, artists):
+        """
+            Yields the top songs of all the artists shuffled. Nothing is resolved until the first one is
+            requested.
+
+            :param artists: List of artist dicts.
+        """
+        tracks = []
+        for artist in artists:
+            url = 'artists/%s/top-tracks' % artist['id']
+            for track in self._catalog_cache.get(self.sp, url, country='US')['tracks']:
+                tracks.append(track['uri'])
+        random.shuffle(tracks)
+        yield from tracks
+
+    def _rank_similar(self, song_uri, candidates, limit, tempo_range=None, energy_range=None):
+        """
+            Returns the candidates closest to a song by their audio features.
+
+            :param song_uri: Reference song URI.
+            :param candidates: List of song URIs to rank.
+            :param limit: Number of songs to return.
+            :param tempo_range: Optional (min, max) tempo in BPM.
+            :param energy_range: Optional (min, max) energy, between 0 and 1.
+            :return: List of song URIs, closest first.
+            :raises IndexError: There is no results.
+        """
+        self._audio_features.fetch(self.sp, [song_uri] + candidates)
+        try:
+            uris = self._audio_features.nearest(song_uri, candidates, limit, tempo_range, energy_range)
+        except KeyError:
+            uris = []
+        if not uris:
+            raise IndexError('There is no results.')
+        return uris
+
+    def _get_saved_tracks(self, refresh_interval=3600):
+        """
+            Returns the URIs of the songs saved on user's library, newest first.
+
+            The list is cached and refreshed after refresh_interval seconds. Saved songs come newest
+            first, so a refresh stops at the first song already cached and merges the new ones in front.
+            If the result doesn't match the library's total, songs were removed and it's downloaded again.
+
+            :param refresh_interval: Seconds during which the cached list is used.
+            :return: List of song URIs.
+        """
+        now = time.monotonic()
+        if self._saved_tracks is None or now - self._saved_tracks_refreshed_at >= refresh_interval:
+            cached = set(self._saved_tracks or ())
+            uris = []
+            page = self.sp.current_user_saved_tracks(50)
+            total = page['total']
+            while page:
+                new_uris = list(takewhile(lambda uri: uri not in cached,
+                                          (item['track']['uri'] for item in page['items'])))
+                uris.extend(new_uris)
+                page = self.sp.next(page) if len(new_uris) == len(page['items']) else None
+            if cached:
+                uris.extend(self._saved_tracks)
+                if len(uris) != total:
+                    self._saved_tracks = None
+                    return self._get_saved_tracks(refresh_interval)
+            self._saved_tracks = uris
+            self._saved_tracks_refreshed_at = now
+        return self._saved_tracks
+
+    def _record_playback(self, status):
+        """
+            Records a playback read on history.
+
+            :param status: Currently playing or playback dict.
+        """
+        if self.history is not None and status and status.get('item'):
+            item = status['item']
+            device = status.get('device') or {}
+            self.history.record(item.get('id') or item['uri'], time.time(), status.get('progress_ms') or 0,
+                                device.get('id'))
+
+    @contextmanager
+    def _device_breaker(self, device_id):
+        """
+            Runs a device call through the device's circuit breaker.
+
+            Nested calls of the same thread, as previous_song calling restart_song, count once.
+
+            :param device_id: Device target, if it's not set, target is current device.
+            :raises ConnectionError: The breaker is open or the device is still unreachable.
+        """
+        breaker = self._breakers.setdefault(device_id, _CircuitBreaker())
+        outermost = breaker.depth == 0
+        allowed = breaker.allow() if outermost else 'call'
+        if not allowed:
+            raise ConnectionError('There is no active device or device_id is not valid.')
+        breaker.depth += 1
+        try:
+            if allowed == 'probe' and not self._is_device_available(device_id):
+                raise ConnectionError('There is no active device or device_id is not valid.')
+            yield
+        except ConnectionError:
+            if outermost:
+                breaker.record_failure()
+            raise
+        else:
+            if outermost:
+                breaker.record_success()
+        finally:
+            breaker.depth -= 1
+            if allowed == 'probe':
+                breaker.end_probe()
+
+    def _is_device_available(self, device_id=None):
+        """
+            Checks if a device is listed on the user's devices.
+
+            :param device_id: Device target, if it's not set, checks if there is an active device.
+        """
+        for dev in self.sp.devices()['devices']:
+            if (dev['id'] == device_id if device_id else dev['is_active']) and not dev['is_restricted']:
+                return True
+        return False
 
     def _get_available_devices(self):
         """